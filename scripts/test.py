@@ -7,7 +7,7 @@ Makefile, run the tests and store the outputs in bin/output.
 This script will also generate a JUnit XML file, which can be used to integrate
 with CI/CD pipelines.
 
-Usage: test.py [-h] [-m] [-v] [--version] [dir]
+Usage: test.py [-h] [-m] [-j JOBS] [-v] [--no-make-check] [--version] [dir]
 
 Example usage: scripts/test.py compiler_tests/_example
 
@@ -25,10 +25,16 @@ __author__ = "William Huynh (@saturn691)"
 import argparse
 import os
 import shutil
+import signal
 import subprocess
-import queue
+import sys
+import termios
+import threading
+from dataclasses import dataclass
 from pathlib import Path
-from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import BinaryIO, Optional
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from itertools import islice
 
 
 # "File" will suggest the absolute path to the file, including the extension.
@@ -39,39 +45,82 @@ J_UNIT_OUTPUT_FILE = PROJECT_LOCATION.joinpath(
     "bin/junit_results.xml").resolve()
 COMPILER_TEST_FOLDER = PROJECT_LOCATION.joinpath("compiler_tests").resolve()
 COMPILER_FILE = PROJECT_LOCATION.joinpath("bin/c_compiler").resolve()
+# Everything bin/c_compiler is built from, see the Makefile.
+COMPILER_SOURCE_FOLDERS = [
+    PROJECT_LOCATION.joinpath("src"),
+    PROJECT_LOCATION.joinpath("include"),
+]
+COMPILER_SOURCE_SUFFIXES = (".cpp", ".hpp", ".h", ".y", ".flex")
+MAKEFILE = PROJECT_LOCATION.joinpath("Makefile")
+# Absolute paths to the toolchain, looked up once. Passing subprocess an
+# executable with a directory in it, and close_fds=False, lets CPython start
+# each tool with posix_spawn instead of fork + exec. None of the files this
+# script opens are inherited by the children either way (PEP 446).
+RISCV_GCC = (
+    shutil.which("riscv64-unknown-elf-gcc") or "riscv64-unknown-elf-gcc"
+)
+SPIKE = shutil.which("spike") or "spike"
+# Number of CPUs this process may actually run on, e.g. inside a CI container.
+CPU_COUNT = (
+    len(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity")
+    else os.cpu_count() or 1
+)
 
 
 class ProgressBar:
     """
     Creates a CLI progress bar that can update itself, provided nothing gets
-    in the way.
+    in the way. The bar is drawn on stderr, leaving stdout to the test logs.
 
     Parameters:
     - total_tests: the length of the progress bar.
     """
 
-    def __init__(self, total_tests):
+    def __init__(self, total_tests: int):
         self.total_tests = total_tests
         self.passed = 0
         self.failed = 0
+        self.lock = threading.Lock()
 
-        _, max_line_length = os.popen("stty size", "r").read().split()
-        self.max_line_length = min(
-            int(max_line_length) - len("Running Tests []"),
-            80 - len("Running Tests []")
-        )
+        self._resize()
+
+        # Re-read the terminal width whenever the window is resized
+        if hasattr(signal, "SIGWINCH"):
+            signal.signal(signal.SIGWINCH, lambda *_: self._resize())
 
         # Initialize the lines for the progress bar and stats
-        print("Running Tests [" + " " * self.max_line_length + "]")
-        print("Pass: 0 | Fail: 0 | Remaining: {}".format(total_tests))
-        print("See logs for more details (use -v for verbose output).")
+        print("Running Tests [" + " " * self.max_line_length + "]",
+              file=sys.stderr)
+        print("Pass: 0 | Fail: 0 | Remaining: {}".format(total_tests),
+              file=sys.stderr)
+        print("See logs for more details (use -v for verbose output).",
+              file=sys.stderr)
 
         # Initialize the progress bar
         self.update()
 
+    def _resize(self):
+        try:
+            max_line_length = os.get_terminal_size(sys.stderr.fileno()).columns
+        except OSError:
+            # Not attached to a terminal
+            max_line_length = 80
+
+        # Keep at least one column, even on very narrow terminals
+        self.max_line_length = max(1, min(
+            max_line_length - len("Running Tests []"),
+            80 - len("Running Tests []")
+        ))
+
     def update(self):
         remaining_tests = self.total_tests - (self.passed + self.failed)
-        progress_bar = ""
+
+        # On large test suites many tests map onto a single column, so only
+        # redraw when a column may have changed, or when the run is finished.
+        tests_per_column = max(1, self.total_tests // self.max_line_length)
+        if remaining_tests > 0 and \
+                (self.passed + self.failed) % tests_per_column != 0:
+            return
 
         if self.total_tests == 0:
             prop_passed = 0
@@ -89,18 +138,27 @@ class ProgressBar:
 
         remaining = self.max_line_length - prop_passed - prop_failed
 
-        progress_bar += '\033[92m#\033[0m' * prop_passed    # Green
-        progress_bar += '\033[91m#\033[0m' * prop_failed    # Red
-        progress_bar += ' ' * remaining                     # Empty space
-
-        # Move the cursor up 3 lines, to the beginning of the progress bar
-        print("\033[3A\r", end='')
+        # Green, then red, then empty space
+        progress_bar = (
+            f'\033[92m{"#" * prop_passed}'
+            f'\033[91m{"#" * prop_failed}'
+            f'\033[0m{" " * remaining}'
+        )
 
-        print("Running Tests [{}]".format(progress_bar))
+        # Move the cursor up 3 lines, to the beginning of the progress bar,
+        # then redraw all of them in a single write.
         # Space is left there intentionally to flush out the command line
-        print("Pass: {:2} | Fail: {:2} | Remaining: {:2} ".format(
-            self.passed, self.failed, remaining_tests))
-        print("See logs for more details (use -v for verbose output).")
+        output = (
+            "\033[3A\r"
+            f"Running Tests [{progress_bar}]\n"
+            f"Pass: {self.passed:2} | Fail: {self.failed:2} | "
+            f"Remaining: {remaining_tests:2} \n"
+            "See logs for more details (use -v for verbose output).\n"
+        )
+
+        with self.lock:
+            sys.stderr.write(output)
+            sys.stderr.flush()
 
     def test_passed(self):
         self.passed += 1
@@ -111,78 +169,160 @@ class ProgressBar:
         self.update()
 
 
-def fail_testcase(
-    init_message: tuple[str, str],
-    message: str,
-    log_queue: queue.Queue
-):
+class JUnitXMLFile:
+    """
+    Writes the JUnit XML test suite to a file, adding the header on entry and
+    the footer on exit. Messages are UTF-8 encoded bytes. They are collected
+    in memory and written out in one go once FLUSH_SIZE bytes are pending,
+    or when the file is closed.
+
+    Parameters:
+    - path: the path of the XML file.
+    """
+
+    FLUSH_SIZE = 256 * 1024
+
+    fd: BinaryIO
+
+    def __init__(self, path: Path):
+        self.path = path
+        self.buffer = bytearray()
+
+    def __enter__(self):
+        self.fd = open(self.path, "wb")
+        self.write(b'<?xml version="1.0" encoding="UTF-8"?>\n')
+        self.write(b'<testsuite name="Integration test">\n')
+        return self
+
+    def __exit__(self, *args):
+        self.write(b'</testsuite>\n')
+        self.flush()
+        os.fsync(self.fd.fileno())
+        self.fd.close()
+
+    def write(self, xml_message: bytes):
+        self.buffer += xml_message
+        if len(self.buffer) > self.FLUSH_SIZE:
+            self.flush()
+
+    def flush(self):
+        self.fd.write(self.buffer)
+        self.fd.flush()
+        self.buffer.clear()
+
+
+@dataclass(slots=True)
+class TestCase:
+    """
+    The paths used by a single test case, worked out once during discovery.
+
+    Parameters:
+    - driver: the *_driver.c file.
+    - to_assemble: the .c file to be compiled.
+    - log_path: where the logs and build outputs are stored, without the
+      suffix, e.g. .../bin/output/_example/example/example
+    """
+    driver: Path
+    to_assemble: Path
+    log_path: Path
+
+    @classmethod
+    def from_driver(cls, driver: Path) -> "TestCase":
+        # Replaces example_driver.c -> example.c
+        new_name = driver.stem.replace('_driver', '') + '.c'
+        to_assemble = driver.parent.joinpath(new_name)
+
+        # Determine the relative path to the file wrt. COMPILER_TEST_FOLDER.
+        relative_path = to_assemble.relative_to(COMPILER_TEST_FOLDER)
+
+        log_path = OUTPUT_FOLDER.joinpath(
+            relative_path.parent, to_assemble.stem, to_assemble.stem
+        )
+
+        return cls(driver, to_assemble, log_path)
+
+
+# The stdout message, the JUnit XML message and whether the test case passed.
+TestResult = tuple[str, bytes, bool]
+
+
+def encode_xml(xml_message: str) -> bytes:
+    """
+    Encodes a JUnit XML message. Test case names come from file names, so any
+    bytes in them that are not valid UTF-8 are written back out unchanged,
+    the same as os.fsencode does for paths.
+    """
+    return xml_message.encode("utf-8", "surrogateescape")
+
+
+def fail_testcase(test_case_name: str, message: str) -> TestResult:
     """
-    Updates the log queue with the JUnit and the stdout fail message.
+    Creates the result of a failed test case, with the JUnit and the stdout
+    fail message.
     """
-    init_print_message, init_xml_message = init_message
-    print_message = f"\t> {message}"
+    print_message = f"{test_case_name}\n\t> {message}"
     xml_message = (
+        f'<testcase name="{test_case_name}">\n'
         f'<error type="error" message="{message}">{message}</error>\n'
         '</testcase>\n'
     )
-    log_queue.put((init_print_message + print_message,
-                   init_xml_message + xml_message))
+    return print_message, encode_xml(xml_message), False
 
 
-def run_test(driver: Path, log_queue: queue.Queue) -> int:
+def run_logged(args: list, log_name: str) -> subprocess.CompletedProcess:
     """
-    Run an instance of a test case.
-
-    Returns:
-    1 if passed, 0 otherwise. This is to increment the pass counter.
+    Runs a command with its stdout and stderr going straight into
+    {log_name}.stdout.log and {log_name}.stderr.log, without passing
+    through Python. The log files are closed as soon as the command exits.
     """
+    with open(f"{log_name}.stdout.log", "wb") as stdout, \
+            open(f"{log_name}.stderr.log", "wb") as stderr:
+        return subprocess.run(
+            args, stdout=stdout, stderr=stderr, close_fds=False)
 
-    # Replaces example_driver.c -> example.c
-    new_name = driver.stem.replace('_driver', '') + '.c'
-    to_assemble = driver.parent.joinpath(new_name).resolve()
 
-    # Determine the relative path to the file wrt. COMPILER_TEST_FOLDER.
-    relative_path = to_assemble.relative_to(COMPILER_TEST_FOLDER)
+def run_test(test_case: TestCase) -> TestResult:
+    """
+    Run an instance of a test case.
 
-    # Construct the path where logs would be stored, without the suffix
-    # e.g. .../bin/output/_example/example/example
-    log_path = Path(OUTPUT_FOLDER).joinpath(
-        relative_path.parent, to_assemble.stem, to_assemble.stem
-    )
+    Returns:
+    The messages to log, and whether the test case passed.
+    """
+    driver = test_case.driver
+    to_assemble = test_case.to_assemble
+    log_path = test_case.log_path
 
     # Ensure the directory exists.
     log_path.parent.mkdir(parents=True, exist_ok=True)
 
-    init_message = (str(to_assemble) + "\n",
-                    f'<testcase name="{to_assemble}">\n')
+    test_case_name = str(to_assemble)
+    test_case_name_bytes = encode_xml(test_case_name)
 
     for suffix in [".s", ".o", ""]:
         log_path.with_suffix(suffix).unlink(missing_ok=True)
 
     # Compile
-    compiler_result = subprocess.run(
+    compiler_result = run_logged(
         [
             COMPILER_FILE,
             "-S", str(to_assemble),
             "-o", f"{log_path}.s",
         ],
-        stderr=open(f"{log_path}.compiler.stderr.log", "w"),
-        stdout=open(f"{log_path}.compiler.stdout.log", "w")
+        f"{log_path}.compiler"
     )
 
     if compiler_result.returncode != 0:
-        fail_testcase(
-            init_message,
+        return fail_testcase(
+            test_case_name,
             f"Fail: see {log_path}.compiler.stderr.log "
-            f"and {log_path}.compiler.stdout.log",
-            log_queue
+            f"and {log_path}.compiler.stdout.log"
         )
-        return 0
 
-    # GCC Reference Output
-    gcc_result = subprocess.run(
+    # GCC Reference Output. Nothing below depends on it, so let it run in the
+    # background while the test case is assembled, linked and simulated.
+    gcc_process = subprocess.Popen(
         [
-            "riscv64-unknown-elf-gcc",
+            RISCV_GCC,
             "-std=c90",
             "-pedantic",
             "-ansi",
@@ -191,95 +331,167 @@ def run_test(driver: Path, log_queue: queue.Queue) -> int:
             "-mabi=ilp32d",
             "-o", f"{log_path}.gcc.s",
             "-S", str(to_assemble)
-        ]
-    )
-
-    # Assemble
-    assembler_result = subprocess.run(
-        [
-            "riscv64-unknown-elf-gcc",
-            "-march=rv32imfd", "-mabi=ilp32d",
-            "-o", f"{log_path}.o",
-            "-c", f"{log_path}.s"
         ],
-        stderr=open(f"{log_path}.assembler.stderr.log", "w"),
-        stdout=open(f"{log_path}.assembler.stdout.log", "w")
+        close_fds=False
     )
 
-    if assembler_result.returncode != 0:
-        fail_testcase(
-            init_message,
-            f"Fail: see {log_path}.assembler.stderr.log "
-            f"and {log_path}.assembler.stdout.log",
-            log_queue
+    try:
+        # Assemble
+        assembler_result = run_logged(
+            [
+                RISCV_GCC,
+                "-march=rv32imfd", "-mabi=ilp32d",
+                "-o", f"{log_path}.o",
+                "-c", f"{log_path}.s"
+            ],
+            f"{log_path}.assembler"
         )
-        return 0
 
-    # Link
-    linker_result = subprocess.run(
-        [
-            "riscv64-unknown-elf-gcc",
-            "-march=rv32imfd", "-mabi=ilp32d", "-static",
-            "-o", f"{log_path}",
-            f"{log_path}.o", str(driver)
-        ],
-        stderr=open(f"{log_path}.linker.stderr.log", "w"),
-        stdout=open(f"{log_path}.linker.stdout.log", "w")
-    )
+        if assembler_result.returncode != 0:
+            return fail_testcase(
+                test_case_name,
+                f"Fail: see {log_path}.assembler.stderr.log "
+                f"and {log_path}.assembler.stdout.log"
+            )
 
-    if linker_result.returncode != 0:
-        fail_testcase(
-            init_message,
-            f"Fail: see {log_path}.linker.stderr.log "
-            f"and {log_path}.linker.stdout.log",
-            log_queue
+        # Link
+        linker_result = run_logged(
+            [
+                RISCV_GCC,
+                "-march=rv32imfd", "-mabi=ilp32d", "-static",
+                "-o", f"{log_path}",
+                f"{log_path}.o", str(driver)
+            ],
+            f"{log_path}.linker"
         )
-        return 0
 
-    # Simulate
-    try:
-        simulation_result = subprocess.run(
-            ["spike", "pk", log_path],
-            stdout=open(f"{log_path}.simulation.log", "w"),
-            timeout=3
-        )
-    except subprocess.TimeoutExpired:
-        print("The subprocess timed out.")
-        simulation_result = subprocess.CompletedProcess(args=[], returncode=1)
-
-    if simulation_result.returncode != 0:
-        fail_testcase(
-            init_message,
-            f"Fail: simulation did not exit with exitcode 0",
-            log_queue
-        )
-        return 0
-    else:
-        init_print_message, init_xml_message = init_message
-        log_queue.put((init_print_message + "\t> Pass",
-                       init_xml_message + "</testcase>\n"))
+        if linker_result.returncode != 0:
+            return fail_testcase(
+                test_case_name,
+                f"Fail: see {log_path}.linker.stderr.log "
+                f"and {log_path}.linker.stdout.log"
+            )
+
+        # Simulate
+        try:
+            with open(f"{log_path}.simulation.log", "wb") as simulation_log:
+                simulation_result = subprocess.run(
+                    [SPIKE, "pk", log_path],
+                    stdout=simulation_log,
+                    timeout=3,
+                    close_fds=False
+                )
+        except subprocess.TimeoutExpired:
+            print("The subprocess timed out.")
+            simulation_result = subprocess.CompletedProcess(
+                args=[], returncode=1)
+
+        if simulation_result.returncode != 0:
+            return fail_testcase(
+                test_case_name,
+                f"Fail: simulation did not exit with exitcode 0"
+            )
+        else:
+            return (
+                f"{test_case_name}\n\t> Pass",
+                b'<testcase name="%s">\n</testcase>\n' % test_case_name_bytes,
+                True
+            )
+    finally:
+        gcc_process.wait()
 
-    return 1
 
+def find_drivers(root: Path) -> list[Path]:
+    """
+    Recursively finds all the *_driver.c files under root.
 
-def empty_log_queue(
-    log_queue: queue.Queue,
+    Uses os.scandir rather than Path.rglob, so directories are told apart
+    from files without a stat() per entry and Path objects are only built
+    for the drivers themselves. Like rglob, a root that does not exist or is
+    not a directory, and any unreadable directory, yields no drivers.
+    """
+    drivers = []
+    stack = [str(root)]
+
+    while stack:
+        try:
+            entries = os.scandir(stack.pop())
+        except OSError:
+            continue
+
+        with entries:
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    stack.append(entry.path)
+                elif entry.name.endswith("_driver.c"):
+                    drivers.append(Path(entry.path))
+
+    return drivers
+
+
+def compiler_up_to_date() -> bool:
+    """
+    Checks whether bin/c_compiler is newer than the Makefile and every source
+    file it is built from, in which case there is no need to run make.
+    """
+    try:
+        compiler_mtime = COMPILER_FILE.stat().st_mtime
+        if MAKEFILE.stat().st_mtime > compiler_mtime:
+            return False
+
+        for folder in COMPILER_SOURCE_FOLDERS:
+            with os.scandir(folder) as entries:
+                for entry in entries:
+                    if entry.name.endswith(COMPILER_SOURCE_SUFFIXES) and \
+                            entry.stat().st_mtime > compiler_mtime:
+                        return False
+    except FileNotFoundError:
+        # Let make decide what is missing
+        return False
+
+    return True
+
+
+def process_result(
+    result: TestResult,
+    xml_file: JUnitXMLFile,
     verbose: bool = False,
-    progress_bar: ProgressBar = None
-):
-    while not log_queue.empty():
-        print_msg, xml_message = log_queue.get()
+    progress_bar: Optional[ProgressBar] = None
+) -> bool:
+    """
+    Logs the result of a test case to the terminal and the JUnit XML file.
 
-        if verbose:
-            print(print_msg)
+    Returns:
+    True if the test case passed, False otherwise.
+    """
+    print_message, xml_message, passed = result
+    xml_file.write(xml_message)
+
+    if verbose:
+        print(print_message)
+    elif progress_bar:
+        if passed:
+            progress_bar.test_passed()
         else:
-            if "Pass" in print_msg:
-                progress_bar.test_passed()
-            elif "Fail" in print_msg:
-                progress_bar.test_failed()
+            progress_bar.test_failed()
+
+    return passed
 
-        with open(J_UNIT_OUTPUT_FILE, "a") as xml_file:
-            xml_file.write(xml_message)
+
+def positive_int(value: str) -> int:
+    """
+    Parses a command line argument that must be a whole number above zero.
+    """
+    try:
+        number = int(value)
+    except ValueError:
+        number = 0
+
+    if number < 1:
+        raise argparse.ArgumentTypeError(
+            f"must be a positive integer, got '{value}'")
+
+    return number
 
 
 def main():
@@ -300,6 +512,13 @@ def main():
         help="Use multiple threads to run tests. This will make it faster, "
         "but order is not guaranteed. Should only be used for speed."
     )
+    parser.add_argument(
+        "-j", "--jobs",
+        type=positive_int,
+        default=CPU_COUNT,
+        help="Number of tests to run in parallel when multithreading. "
+        "Defaults to the number of available CPUs. Has no effect without -m."
+    )
     parser.add_argument(
         "-v", "--verbose",
         action="store_true",
@@ -307,6 +526,13 @@ def main():
         help="Enable verbose output into the terminal. Note that all logs will "
         "be stored automatically into log files regardless of this option."
     )
+    parser.add_argument(
+        "--no-make-check",
+        action="store_true",
+        default=False,
+        help="Always run make, even if bin/c_compiler is newer than all of "
+        "its sources."
+    )
     parser.add_argument(
         "--version",
         action="version",
@@ -321,46 +547,91 @@ def main():
 
     Path(OUTPUT_FOLDER).mkdir(parents=True, exist_ok=True)
 
-    subprocess.run(["make", "-C", PROJECT_LOCATION, "bin/c_compiler"])
-
-    with open(J_UNIT_OUTPUT_FILE, "w") as f:
-        f.write('<?xml version="1.0" encoding="UTF-8"?>\n')
-        f.write('<testsuite name="Integration test">\n')
-
-    drivers = list(Path(args.dir).rglob("*_driver.c"))
-    drivers = sorted(drivers, key=lambda p: (p.parent.name, p.name))
-    log_queue = queue.Queue()
-    results = []
-    progress_bar = ProgressBar(len(drivers))
-
-    if args.multithreading:
-        with ThreadPoolExecutor() as executor:
-            futures = [executor.submit(run_test, driver, log_queue)
-                       for driver in drivers]
+    make_process = None
+    if args.no_make_check or not compiler_up_to_date():
+        make_process = subprocess.Popen(
+            ["make", "-C", PROJECT_LOCATION, "bin/c_compiler"])
+    else:
+        print("bin/c_compiler is up-to-date")
 
-            for future in as_completed(futures):
-                results.append(future.result())
-                empty_log_queue(log_queue, args.verbose, progress_bar)
+    # Discovering the tests does not depend on the compiler, so do it while
+    # make is building. Always wait for make, even if discovery fails, so it
+    # is never left running after the script has exited.
+    try:
+        # Resolve the root once, so every driver found below it is already
+        # an absolute path and needs no further resolving.
+        drivers = find_drivers(args.dir.resolve())
+        drivers = sorted(drivers, key=lambda p: (p.parent.name, p.name))
+        test_cases = [TestCase.from_driver(driver) for driver in drivers]
+    finally:
+        if make_process:
+            make_process.wait()
+
+    if make_process and make_process.returncode != 0:
+        print("Error: failed to build bin/c_compiler")
+        sys.exit(1)
+
+    results = [False] * len(test_cases)
+    # Only draw the progress bar when nothing else is written to the terminal
+    progress_bar = None
+    if not args.verbose and sys.stderr.isatty():
+        progress_bar = ProgressBar(len(drivers))
+
+    with JUnitXMLFile(J_UNIT_OUTPUT_FILE) as xml_file:
+        if args.multithreading:
+            with ThreadPoolExecutor(max_workers=args.jobs) as executor:
+                # Only keep a few tests per worker in flight, submitting the
+                # next ones as tests finish, rather than everything upfront.
+                # Each future maps to the index of its test case in results.
+                pending = enumerate(test_cases)
+                in_flight = {
+                    executor.submit(run_test, test_case): i
+                    for i, test_case in islice(pending, 4 * args.jobs)
+                }
+
+                while in_flight:
+                    done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+
+                    for future in done:
+                        results[in_flight.pop(future)] = process_result(
+                            future.result(), xml_file, args.verbose,
+                            progress_bar)
+
+                    for i, test_case in islice(pending, len(done)):
+                        in_flight[executor.submit(run_test, test_case)] = i
 
-    else:
-        for driver in drivers:
-            result = run_test(driver, log_queue)
-            results.append(result)
-            empty_log_queue(log_queue, args.verbose, progress_bar)
+        else:
+            for i, test_case in enumerate(test_cases):
+                result = run_test(test_case)
+                results[i] = process_result(
+                    result, xml_file, args.verbose, progress_bar)
 
     passing = sum(results)
     total = len(drivers)
 
-    with open(J_UNIT_OUTPUT_FILE, "a") as f:
-        f.write('</testsuite>\n')
-
     print("\n>> Test Summary: {} Passed, {} Failed".format(
         passing, total-passing))
 
 
+def restore_terminal_echo():
+    """
+    Turns the terminal's echo back on, the same as running "stty echo".
+    """
+    if not sys.stdin.isatty():
+        return
+
+    try:
+        fd = sys.stdin.fileno()
+        attributes = termios.tcgetattr(fd)
+        attributes[3] |= termios.ECHO
+        termios.tcsetattr(fd, termios.TCSADRAIN, attributes)
+    except (termios.error, OSError):
+        pass
+
+
 if __name__ == "__main__":
     try:
         main()
     finally:
         # This solves dodgy terminal behaviour on multithreading
-        os.system("stty echo")
+        restore_terminal_echo()